@@ -14,9 +14,22 @@ import os
 import sys
 import traceback
 import argparse
-from datetime import datetime
-from time import time, sleep
-from threading import Thread, Lock
+import json
+import math
+import numbers
+import select
+from collections import deque
+from datetime import datetime, timedelta
+from time import time
+try:
+	from time import monotonic
+except ImportError:	# Python 2
+	monotonic = time
+from threading import Thread, Event
+try:
+	from queue import Queue
+except ImportError:	# Python 2
+	from Queue import Queue
 
 from fcntl import ioctl
 import struct, array
@@ -25,7 +38,9 @@ import struct, array
 __dir__ = os.path.dirname(__file__)
 sys.path.insert(0, os.path.join(__dir__, 'deps'))
 
-import gspread
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
 from oauth2client.client import flow_from_clientsecrets
 from oauth2client.file import Storage
 
@@ -53,15 +68,26 @@ class lirc:
 
 	DEBUG_LOG = None
 
+	READ_SIZE = 4096	# bytes fetched per read() syscall
+
+	SAMPLE = struct.Struct('I')
+
 	def __init__(self, dev):
 		self.dev = dev
-		self.fd = open(dev, 'rb')
-		self.value_struct = struct.Struct('I')
+		self.fd = os.open(dev, os.O_RDONLY)
+
+		# samples are served from this buffer, refilled in bulk
+		self._buf = b''
+		self._pos = 0
+
+		self.poller = select.poll()
+		self.poller.register(self.fd, select.POLLIN)
 
 		# for debug logging
 		self.debug_fd = None
 		if self.DEBUG_LOG is not None:
-			self.debug_fd = open(self.DEBUG_LOG, 'wb')
+			self.debug_fd = os.open(self.DEBUG_LOG, 
+					os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
 
 	def ioctl(self, req):
 		buf = array.array('I', [0])
@@ -76,18 +102,32 @@ class lirc:
 		r, val = self.ioctl(self.LIRC_GET_REC_MODE)
 		return val if r == 0 else None
 
+	def wait(self, timeout=None):
+		"""Waits up to timeout ms (forever if None) for a sample to be 
+		available. Returns False if the timeout expired."""
+		if self._pos < len(self._buf):
+			return True
+		return bool(self.poller.poll(timeout))
+
 	def read(self):
-		readval = self.fd.read(self.value_struct.size)
-		if self.debug_fd:
-			self.debug_fd.write(readval)
-		v, = self.value_struct.unpack(readval)
+		sample = self.SAMPLE
+		if self._pos + sample.size > len(self._buf):
+			self._buf = os.read(self.fd, self.READ_SIZE)
+			self._pos = 0
+			if len(self._buf) < sample.size:
+				raise EOFError('short read from %s' % self.dev)
+			if self.debug_fd is not None:
+				os.write(self.debug_fd, self._buf)
+
+		v, = sample.unpack_from(self._buf, self._pos)
+		self._pos += sample.size
 		return v & self.PULSE_BIT != 0, v & self.PULSE_MASK
 
 
 class gpioled:
 	def _open(self, path):
 		self.path = path
-		self.fd = open(path, 'wb', 0)
+		self.fd = os.open(path, os.O_WRONLY)
 		self.state = True	# initial state
 
 	def __init__(self, pin):
@@ -110,20 +150,20 @@ class gpioled:
 	def __del__(self):
 		if self.fd is not None:
 			self.set_state(False)
-			self.fd.close()
+			os.close(self.fd)
 
 	def set_state(self, state):
 		self.state = bool(state)
-		self.fd.write('1' if self.state else '0')
+		os.write(self.fd, b'1' if self.state else b'0')
 
 	def toggle(self):
-		self.set_state(self.state)
-		self.state = not self.state
+		self.set_state(not self.state)
 
 
 class weight_state:
 	def __init__(self):
-		self.update_lock = Lock()
+		self.stable_event = Event()	# set once the weight looks stable
+		self.update_event = Event()	# set on every update
 
 		self.stable_count = 0
 		self.last_stable_time = 0
@@ -133,7 +173,7 @@ class weight_state:
 		self.weight = 0
 
 	def update(self, is_stable, weight):
-		now = time()
+		now = monotonic()
 		if is_stable:
 			self.stable_count += 1
 			self.last_stable_time = now
@@ -144,46 +184,216 @@ class weight_state:
 		self.last_update_time = now
 		self.weight = weight
 
-	def can_record(self):
-		now = time()
-		return self.stable_count >= 10 and \
-			self.stable_weight > 0 and \
-			now - self.last_stable_time > 2
+		self.update_event.set()
+		if self.stable_count > 10:
+			self.stable_event.set()
+
+	def record_delay(self):
+		"""Returns the number of seconds until the weight can be recorded,
+		provided no further updates arrive, or None if it can't be."""
+		if self.stable_count < 10 or self.stable_weight <= 0:
+			return None
+		return max(0, self.last_stable_time + 2 - monotonic())
+
+
+class pending_rows:
+	"""Rows waiting to be appended to the spreadsheet. These are kept on 
+	disk as well, so readings taken while offline survive a restart.
+	Timestamps are kept as seconds since the epoch until they are sent."""
+
+	TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+	def __init__(self, path):
+		self.path = path
+		self.rows = deque()
+
+		if os.path.exists(path):
+			self._load()
+
+	def _load(self):
+		try:
+			with open(self.path) as f:
+				rows = json.load(f)
+		except (IOError, OSError, ValueError) as e:
+			print('ignoring unreadable pending rows in', self.path, e)
+			return
+
+		if not isinstance(rows, list):
+			print('ignoring pending rows in', self.path, '- not a list')
+			return
+
+		for row in rows:
+			if self._valid_row(row):
+				self.rows.append(tuple(row))
+			else:
+				print('dropping malformed pending row', repr(row))
+
+	def _valid_row(self, row):
+		"""Checks for a (timestamp, weight) pair that flush() can send."""
+		if not isinstance(row, list) or len(row) != 2:
+			return False
+
+		for v in row:
+			if isinstance(v, bool) or not isinstance(v, numbers.Real) or \
+					math.isnan(v) or math.isinf(v):
+				return False
+
+		try:
+			datetime.fromtimestamp(row[0])
+		except (ValueError, OverflowError, OSError):
+			return False
+
+		return True
+
+	def __len__(self):
+		return len(self.rows)
+
+	def add(self, row):
+		self.rows.append(row)
+
+	def save(self):
+		if self.rows:
+			# write a new file and swap it in, so a power cut can't 
+			# leave a truncated one behind
+			tmp_path = self.path + '.tmp'
+			with open(tmp_path, 'w') as f:
+				json.dump(list(self.rows), f)
+				f.flush()
+				os.fsync(f.fileno())
+			os.rename(tmp_path, self.path)
+		elif os.path.exists(self.path):
+			os.remove(self.path)
+
+	def flush(self, sheet):
+		"""Appends all pending rows in a single request. Rows are only 
+		dropped once the request succeeds."""
+
+		rows = list(self.rows)
+		if rows:
+			sheet.append_rows([(datetime.fromtimestamp(t).strftime(self.TIME_FORMAT), w) 
+					for t, w in rows])
+			for _ in rows:
+				self.rows.popleft()
+
+
+class spreadsheet:
+	"""Appends rows to the first sheet of a spreadsheet via the Sheets v4 
+	API. The HTTP session is kept so its connection can be reused."""
+
+	APPEND_URL = 'https://sheets.googleapis.com/v4/spreadsheets/%s/values/A1:append'
+
+	REFRESH_MARGIN = timedelta(minutes=2)	# refresh tokens this close to expiry
+
+	TIMEOUT = 10	# seconds
+	RETRIES = 3		# on connection errors
+
+	def __init__(self, credentials, doc_key):
+		self.credentials = credentials
+		self.url = self.APPEND_URL % doc_key
+		self.http = httplib2.Http()	# for refreshing tokens
+
+		self.session = requests.Session()
+		self.session.mount('https://', HTTPAdapter(max_retries=self.RETRIES))
+		self.set_token()
+
+	def set_token(self):
+		self.session.headers['Authorization'] = 'Bearer %s' % self.credentials.access_token
+
+	def refresh(self):
+		self.credentials.refresh(self.http)
+		self.set_token()
+
+	def refresh_if_expiring(self):
+		expiry = self.credentials.token_expiry
+		if expiry is not None and expiry - datetime.utcnow() < self.REFRESH_MARGIN:
+			self.refresh()
+
+	def _post(self, rows):
+		return self.session.post(self.url,
+				params={'valueInputOption': 'USER_ENTERED'},
+				json={'values': rows},
+				timeout=self.TIMEOUT)
+
+	def append_rows(self, rows):
+		self.refresh_if_expiring()
+
+		r = self._post(rows)
+		if r.status_code == 401:
+			# token was rejected anyway, refresh it and try once more
+			self.refresh()
+			r = self._post(rows)
+
+		r.raise_for_status()
+
+
+# pulse/space length classes, as looked up in PULSE_CLASS
+PULSE_LONG  = 0		# also the bit value it encodes
+PULSE_SHORT = 1		# ditto
+PULSE_GAP   = 3
+PULSE_NOISE = 255
+
+FRAME_TIMEOUT = 150	# ms without IR samples that ends a packet
+
+# accepted pulse/space lengths in us, exclusive bounds
+SHORT_LO, SHORT_HI = 300, 700		# 500 +/- 200
+LONG_LO,  LONG_HI  = 800, 1200		# 1000 +/- 200
+GAP_LO,   GAP_HI   = 60000, 90000	# 75000 +/- 15000
+
+PULSE_CLASS_SHIFT = 4		# table granularity is 16us
+PULSE_CLASS_LIMIT = 8191	# last table entry, ~131ms
+
+
+def make_pulse_class_table():
+	"""Builds a table mapping (pulse_len >> PULSE_CLASS_SHIFT) to its 
+	pulse class, so read_byte doesn't need a chain of range checks."""
+
+	windows = (
+		(SHORT_LO, SHORT_HI, PULSE_SHORT),
+		(LONG_LO,  LONG_HI,  PULSE_LONG),
+		(GAP_LO,   GAP_HI,   PULSE_GAP),
+	)
+
+	table = bytearray([PULSE_NOISE]) * (PULSE_CLASS_LIMIT + 1)
+	for lo, hi, cls in windows:
+		# entries whose first length falls strictly inside (lo, hi)
+		first = (lo >> PULSE_CLASS_SHIFT) + 1
+		last = (hi - 1) >> PULSE_CLASS_SHIFT
+		table[first:last + 1] = bytearray([cls]) * (last + 1 - first)
+
+	return table
+
+PULSE_CLASS = make_pulse_class_table()
 
 
 def read_byte(dev, bits=8):
 	"""Reads a single byte from the IR transmission."""
 
-	margin = 200	# acceptable margin of error
-	margin2 = 15000
 	byte = 0
 	i = 0
-	durations = []
+	read = dev.read
+	table = PULSE_CLASS
 
 	while i < bits:
-		is_pulse, pulse_len = dev.read()
-		durations.extend([is_pulse, pulse_len])
+		is_pulse, pulse_len = read()
 
 		# wait for pulse
 		if not is_pulse and i == 0:
 			continue
 
 		v = -1
-		if is_pulse and 500-margin < pulse_len < 500+margin:
-			is_pulse, pulse_len = dev.read()
-			durations.extend([is_pulse, pulse_len])
+		idx = pulse_len >> PULSE_CLASS_SHIFT
+		if is_pulse and table[idx if idx < PULSE_CLASS_LIMIT else PULSE_CLASS_LIMIT] == PULSE_SHORT:
+			is_pulse, pulse_len = read()
 			if not is_pulse:
-				if 500-margin < pulse_len < 500+margin:
-					v = 1
-				elif 1000-margin < pulse_len < 1000+margin:
-					v = 0
-				elif 75000-margin2 < pulse_len < 75000+margin2 and i == 0:
+				idx = pulse_len >> PULSE_CLASS_SHIFT
+				cls = table[idx if idx < PULSE_CLASS_LIMIT else PULSE_CLASS_LIMIT]
+				if cls <= PULSE_SHORT:
+					v = cls
+				elif cls == PULSE_GAP and i == 0:
 					continue
 
-		# reset bit counter if we didn't see a full byte
+		# give up if we didn't see a valid bit
 		if v == -1:
-			#print(repr(durations))
-			i = 0
 			return None
 
 		byte |= v << (7 - i)
@@ -193,12 +403,30 @@ def read_byte(dev, bits=8):
 
 
 def verify_checksum(data):
-	checksum = 0
-	for n in data[:4]:
-		checksum += n
-		checksum %= 0xff
-	checksum &= ~1
-	assert checksum == data[4]
+	"""Checks the last byte of a 5-byte packet against its checksum."""
+	return sum(data[:4]) % 0xff & ~1 == data[4]
+
+
+def read_packet(dev, data):
+	"""Reads a complete 5-byte packet from the IR transmission into data.
+	Returns whether its checksum is valid."""
+
+	n = 0
+	while n < 5:
+		# a packet in progress is abandoned once the IR goes quiet
+		if not dev.wait(FRAME_TIMEOUT if n else None):
+			n = 0
+			continue
+
+		b = read_byte(dev, 8 if n < 4 else 7)
+		if b is None or (n == 0 and b != 0xAB):
+			n = 0
+			continue
+
+		data[n] = b
+		n += 1
+
+	return verify_checksum(data)
 
 
 def datafile(fname):
@@ -231,39 +459,69 @@ def get_authorization(cache_file):
 	return credentials
 
 
-def record_weight(state, credentials, doc_key):
-	try:
-		timestamp = datetime.now()
+def record_weight(timestamp, weight, sheet, pending):
+	pending.add((timestamp, weight))
 
+	try:
 		print('updating spreadsheet...')
+		pending.flush(sheet)
 
-		gspread_creds = gspread.authorize(credentials)
-		sheet = gspread_creds.open_by_key(doc_key).sheet1
-		sheet.append_row((timestamp, state.stable_weight))
-
-		print('recorded', timestamp, state.stable_weight)
-		return True
-	except:
-		e = sys.exc_info()[1]
+		print('recorded', weight)
+		recorded = True
+	except Exception as e:
 		print('error updating Google spreadsheet', e)
 		traceback.print_exc()
-		return False
-	finally:
-		pass
-
+		print(len(pending), 'row(s) pending')
+		recorded = False
 
-def record_stable_weight(state, led, credentials, doc_key):
+	# unsaved rows are still kept in memory for the next attempt
 	try:
+		pending.save()
+	except Exception as e:
+		print('error saving pending rows', e)
+
+	return recorded
+
+
+def record_stable_weight(state, uploads):
+	"""Waits for the weight to become stable and queues it for upload. 
+	This runs in its own thread for the lifetime of the script."""
+
+	while True:
+		state.stable_event.wait()
+
+		# wait until the stable readings have stopped for a while
 		while True:
-			if state.can_record():
-				led.set_state(True)
-				record_weight(state, credentials, doc_key)
+			state.update_event.clear()
+			delay = state.record_delay()
+			if delay == 0:
 				break
+			state.update_event.wait(delay)
 
-			sleep(0.5)
-	finally:
-		led.set_state(False)
-		state.update_lock.release()
+		# clear first, so stable readings arriving from here on trigger 
+		# the next recording
+		state.stable_event.clear()
+		uploads.put((time(), state.stable_weight))
+
+
+def upload_weights(uploads, led, sheet, pending):
+	"""Records queued weights one at a time. This also runs in its own 
+	thread, so a slow upload doesn't hold up detecting the next weight."""
+
+	while True:
+		timestamp, weight = uploads.get()
+		try:
+			led.set_state(True)
+			try:
+				record_weight(timestamp, weight, sheet, pending)
+			finally:
+				led.set_state(False)
+		except Exception as e:
+			# keep going, this is the only thread doing uploads
+			print('error recording weight', weight, e)
+			traceback.print_exc()
+		finally:
+			uploads.task_done()
 
 
 def main():
@@ -274,60 +532,62 @@ def main():
 	ap.add_argument('--led', default=18, help='GPIO pin (or LED name) for status LED (default: "%(default)s")')
 	ap.add_argument('--tokenfile', default=datafile('gdocs.token'), 
 		help='File which stores the access_token (default: "%(default)s")')
+	ap.add_argument('--pendingfile', default=datafile('pending.json'), 
+		help='File which stores unrecorded weights (default: "%(default)s")')
 	ap.add_argument('spreadsheet_key', help='Spreadsheet "key"')
 	args = ap.parse_args()
 
 	credentials = get_authorization(args.tokenfile)
+	sheet = spreadsheet(credentials, args.spreadsheet_key)
 
 	if args.test:
-		state = weight_state()
-		record_weight(state, credentials, args.spreadsheet_key)
+		# bypasses pending rows, so a failed test doesn't leave one behind
+		sheet.append_rows([(datetime.now().strftime(pending_rows.TIME_FORMAT), 0)])
+		print('test row recorded')
 		sys.exit(0)
 
+	pending = pending_rows(args.pendingfile)
+
 	# main loop
 
 	led = gpioled(args.led)
 	dev = lirc(args.dev)
 	state = weight_state()
-	data = []
+
+	uploads = Queue()
+
+	# start threads to monitor for stable weight and record it
+	recorder = Thread(target=record_stable_weight, args=(state, uploads))
+	recorder.daemon = True
+	recorder.start()
+
+	uploader = Thread(target=upload_weights, args=(uploads, led, sheet, pending))
+	uploader.daemon = True
+	uploader.start()
+
+	data = bytearray(5)	# packet buffer, reused across packets
 
 	print('monitoring LIRC device...')
 
 	while True:
-		num_bits = 8 if len(data) < 4 else 7
-		b = read_byte(dev, num_bits)
-		if b is None or (data and data[0] != 0xAB):
-			data = []
-			continue
-
-		data.append(b)
+		valid = read_packet(dev, data)
 
-		if len(data) == 5:
-			weight = -1
-			try:
-				if args.debug:
-					print(['%02x' % d for d in data])
+		if args.debug:
+			print(['%02x' % d for d in data])
 
-				verify_checksum(data)
-				weight = data[2] << 8 | data[3]
-				weight /= 10.0
+		if not valid:
+			print('checksum failed')
+			continue
 
-				led.toggle()
+		weight = data[2] << 8 | data[3]
+		weight /= 10.0
 
-				if args.debug:
-					print('%02x' % data[1], weight)
+		led.toggle()
 
-				state.update(data[1] == 0x8C, weight)
-			except:
-				print('checksum failed')
-			finally:
-				data = []
+		if args.debug:
+			print('%02x' % data[1], weight)
 
-			# start process to monitor for stable weight and record it
-			if state.stable_count > 10 and state.update_lock.acquire(False):
-				p = Thread(target=record_stable_weight, 
-						args=(state, led, credentials, args.spreadsheet_key))
-				p.start()
+		state.update(data[1] == 0x8C, weight)
 
 
 if __name__ == '__main__':